@@ -1,16 +1,14 @@
 import os
 import math
-import uuid
+import secrets
 import sqlite3
-from datetime import datetime
+from datetime import datetime, timezone
 from io import BytesIO
+from types import SimpleNamespace
 
+import numpy as np
 import pandas as pd
 import streamlit as st
-import pydeck as pdk
-from fpdf import FPDF
-import qrcode
-from PIL import Image
 
 # -------------------------------------------------
 # CONFIG
@@ -22,6 +20,16 @@ DATA_PATH = os.path.join("data", "resources_sample.csv")
 # Centro aproximado (San Diego downtown)
 DEFAULT_COORDS = (32.7157, -117.1611)
 
+# Color por tipo de recurso en el mapa (RGB)
+TYPE_COLORS = {
+    "Shelter": [0, 92, 230],
+    "Food": [0, 160, 60],
+    "Medical": [200, 0, 0],
+    "Hygiene": [200, 160, 0],
+    "Community": [120, 0, 120],
+}
+DEFAULT_TYPE_COLOR = [200, 0, 200]
+
 # DB local SQLite
 DB_PATH = "openhealth.db"
 
@@ -34,53 +42,205 @@ BASE_URL = "http://localhost:8501"
 # -------------------------------------------------
 # UTILS: distancia y carga de recursos
 # -------------------------------------------------
-def haversine_km(lat1, lon1, lat2, lon2):
+R_EARTH_KM = 6371.0
+
+# debajo de este tamano el overhead de los hilos de numba no vale la pena
+NUMBA_MIN_BATCH = 64
+
+# numba.prange dentro de numba_kernel(); sin numba el loop queda en range
+prange = range
+
+
+def _haversine_batch(p1, lmb1, cos_p1, lat2_rad, lon2_rad, cos_lat2, out):
+    """
+    Loop explicito de haversine para compilar con numba (parallel=True).
+    """
+    for i in prange(lat2_rad.shape[0]):
+        a = (
+            math.sin((lat2_rad[i] - p1) / 2) ** 2
+            + cos_p1 * cos_lat2[i] * math.sin((lon2_rad[i] - lmb1) / 2) ** 2
+        )
+        out[i] = 2 * R_EARTH_KM * math.asin(math.sqrt(a))
+    return out
+
+
+@st.cache_resource(show_spinner=False)
+def numba_kernel():
+    """
+    Version compilada con numba de _haversine_batch (en paralelo). Se crea
+    una sola vez por proceso y no en cada rerun. Devuelve None si numba no
+    esta instalado. numba (opcional) se importa aqui y no al cargar el
+    modulo, para no pesar en el arranque.
+    """
+    global prange
+    try:
+        import numba
+    except ImportError:
+        return None
+    # numba lee los globals de _haversine_batch al compilar
+    prange = numba.prange
+    kernel = numba.njit(cache=True, parallel=True, fastmath=True)
+    return kernel(_haversine_batch)
+
+
+def haversine_km_vec(lat1, lon1, lat2_rad, lon2_rad, cos_lat2):
     """
-    Distancia entre (lat1,lon1) y (lat2,lon2) en km usando haversine.
+    Distancia en km desde el punto (lat1,lon1) (en grados) a cada punto de los
+    arrays usando haversine vectorizado (sin loop por fila en Python).
+    lat2_rad/lon2_rad/cos_lat2 vienen precalculados por prepare_resources.
+    Con numba y arrays grandes usa el kernel compilado; si no, numpy.
     """
-    R = 6371.0
     p1 = math.radians(lat1)
-    p2 = math.radians(lat2)
-    dphi = math.radians(lat2 - lat1)
-    dlmb = math.radians(lon2 - lon1)
-    a = math.sin(dphi / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dlmb / 2) ** 2
-    return 2 * R * math.asin(math.sqrt(a))
+    lmb1 = math.radians(lon1)
+    cos_p1 = math.cos(p1)
+    hav_batch = numba_kernel()
+    if hav_batch is not None and len(lat2_rad) >= NUMBA_MIN_BATCH:
+        out = np.empty(len(lat2_rad), dtype=np.float64)
+        return hav_batch(
+            p1,
+            lmb1,
+            cos_p1,
+            np.ascontiguousarray(lat2_rad, dtype=np.float64),
+            np.ascontiguousarray(lon2_rad, dtype=np.float64),
+            np.ascontiguousarray(cos_lat2, dtype=np.float64),
+            out,
+        )
+
+    dphi = lat2_rad - p1
+    dlmb = lon2_rad - lmb1
+    a = np.sin(dphi / 2) ** 2 + cos_p1 * cos_lat2 * np.sin(dlmb / 2) ** 2
+    return 2 * R_EARTH_KM * np.arcsin(np.sqrt(a))
+
+
+def bbox_mask(lat, lon, lat0, lon0, radius_km):
+    """
+    Mascara booleana de los puntos (arrays lat/lon) que caen dentro del
+    cuadro lat/lon que contiene el circulo de radius_km alrededor de
+    (lat0,lon0). Es un prefiltro barato antes de calcular haversine.
+    """
+    dlat_max = radius_km / 111.0
+    # usar el coseno de la latitud mas lejana del ecuador dentro del cuadro
+    # para que el cuadro nunca quede mas chico que el circulo
+    edge_lat = min(abs(lat0) + dlat_max, 90.0)
+    dlon_max = radius_km / (111.0 * max(math.cos(math.radians(edge_lat)), 1e-12))
+    # diferencia de longitud envuelta a [-180, 180) para no perder puntos
+    # del otro lado del antimeridiano
+    dlon = (lon - lon0 + 180.0) % 360.0 - 180.0
+    return (np.abs(lat - lat0) <= dlat_max) & (np.abs(dlon) <= dlon_max)
+
+
+def text_mask(df, query, cols=("_name_l", "_addr_l")):
+    """
+    Mascara booleana de las filas donde query (texto libre) aparece en
+    alguna de las columnas en minusculas precalculadas por prepare_resources.
+    """
+    low = query.strip().lower()
+    return np.logical_or.reduce(
+        [df[c].str.contains(low, regex=False).to_numpy(dtype=bool) for c in cols]
+    )
+
 
+def resources_mtime():
+    """
+    mtime del CSV de recursos (0.0 si no existe). Se usa como llave de cache
+    para que load_resources se recargue solo cuando el archivo cambia.
+    """
+    return os.path.getmtime(DATA_PATH) if os.path.exists(DATA_PATH) else 0.0
 
-def load_resources():
+
+def prepare_resources(df):
+    """
+    Agrega columnas derivadas que no cambian entre reruns:
+    - _name_l, _addr_l, _notes_l: texto en minusculas para la busqueda
+    - type como category (pocos valores distintos)
+    - r, g, b: color del punto en el mapa segun el tipo (uint8)
+    - lat_rad, lon_rad, cos_lat: coordenadas en radianes para haversine
+    """
+    df["_name_l"] = df["name"].fillna("").astype(str).str.lower()
+    df["_addr_l"] = df["address"].fillna("").astype(str).str.lower()
+    df["_notes_l"] = df["notes"].fillna("").astype(str).str.lower()
+
+    df["type"] = df["type"].astype("category")
+    palette = pd.DataFrame(TYPE_COLORS, index=["r", "g", "b"]).T
+    rgb = palette.reindex(df["type"].to_numpy()).fillna(
+        dict(zip(["r", "g", "b"], DEFAULT_TYPE_COLOR))
+    )
+    df[["r", "g", "b"]] = rgb.to_numpy(dtype=np.uint8)
+
+    df["lat_rad"] = np.radians(df["lat"].to_numpy(dtype=float))
+    df["lon_rad"] = np.radians(df["lon"].to_numpy(dtype=float))
+    df["cos_lat"] = np.cos(df["lat_rad"].to_numpy())
+    return df
+
+
+@st.cache_data(show_spinner=False)
+def load_resources(mtime):
     """
     Carga el CSV con ubicaciones de shelters, comida, etc.
     Si no existe o esta vacio, devuelve DataFrame vacio con columnas esperadas.
+    Cacheado por mtime: solo se vuelve a leer si el CSV cambia.
     """
+    columns = ["name", "type", "address", "lat", "lon", "hours", "phone", "notes"]
     if not os.path.exists(DATA_PATH):
-        return pd.DataFrame(
-            columns=["name", "type", "address", "lat", "lon", "hours", "phone", "notes"]
-        )
+        return prepare_resources(pd.DataFrame(columns=columns))
 
     try:
-        df = pd.read_csv(DATA_PATH)
-    except pd.errors.EmptyDataError:
-        return pd.DataFrame(
-            columns=["name", "type", "address", "lat", "lon", "hours", "phone", "notes"]
+        # solo las columnas que usa la app; texto como str para que pandas no
+        # tenga que inferir tipos (ej. telefonos que parecen numeros)
+        df = pd.read_csv(
+            DATA_PATH,
+            usecols=lambda c: c in columns,
+            dtype={c: str for c in columns if c not in ("lat", "lon")},
         )
+    except pd.errors.EmptyDataError:
+        return prepare_resources(pd.DataFrame(columns=columns))
 
     # Asegurar numeric
     df["lat"] = pd.to_numeric(df["lat"], errors="coerce")
     df["lon"] = pd.to_numeric(df["lon"], errors="coerce")
     df = df.dropna(subset=["lat", "lon"])
-    return df
+    return prepare_resources(df)
+
+
+@st.cache_data(show_spinner=False)
+def resource_types(mtime):
+    """
+    Lista ordenada de tipos unicos del CSV (para el filtro del Mapa).
+    """
+    df = load_resources(mtime)
+    return sorted(df["type"].dropna().unique().tolist())
 
 
 # -------------------------------------------------
 # DB LAYER
 # -------------------------------------------------
+def get_conn():
+    """
+    Conexion SQLite compartida por la sesion (se abre una sola vez).
+    WAL + synchronous NORMAL hacen mas baratos los commits.
+    """
+    if "sqlite_conn" not in st.session_state:
+        con = sqlite3.connect(DB_PATH, check_same_thread=False)
+        con.row_factory = sqlite3.Row
+        con.executescript(
+            """
+            PRAGMA journal_mode=WAL;
+            PRAGMA synchronous=NORMAL;
+            PRAGMA temp_store=MEMORY;
+            PRAGMA cache_size=-64000;
+            """
+        )
+        st.session_state.sqlite_conn = con
+    return st.session_state.sqlite_conn
+
+
 def init_db():
     """
-    Crea tablas si no existen:
+    Crea tablas e indices si no existen:
     - persons: perfil medico basico
     - visits: visitas clinicas historicas
     """
-    con = sqlite3.connect(DB_PATH)
+    con = get_conn()
     cur = con.cursor()
     cur.execute(
         """
@@ -93,7 +253,8 @@ def init_db():
             allergies TEXT,
             critical_flags TEXT,
             notes TEXT,
-            updated_at TEXT
+            updated_at TEXT,
+            updated_at_epoch INTEGER
         )
         """
     )
@@ -105,12 +266,40 @@ def init_db():
             when_ TEXT,
             provider TEXT,
             summary TEXT,
+            when_epoch INTEGER,
             FOREIGN KEY(person_id) REFERENCES persons(id)
         )
         """
     )
+
+    # DBs creadas antes de las columnas *_epoch: agregarlas y rellenarlas
+    # desde el texto ISO (se conserva el texto solo para mostrar).
+    # El ALTER hace commit solo, asi que el relleno corre en cada arranque
+    # para lo que siga en NULL: si el proceso murio entre los dos, se completa.
+    migrations = [
+        ("persons", "updated_at_epoch", "updated_at"),
+        ("visits", "when_epoch", "when_"),
+    ]
+    for table, epoch_col, iso_col in migrations:
+        cols = [r["name"] for r in cur.execute(f"PRAGMA table_info({table})")]
+        if epoch_col not in cols:
+            cur.execute(f"ALTER TABLE {table} ADD COLUMN {epoch_col} INTEGER")
+        cur.execute(
+            f"UPDATE {table} "
+            f"SET {epoch_col} = CAST(strftime('%s', {iso_col}) AS INTEGER) "
+            f"WHERE {epoch_col} IS NULL AND {iso_col} IS NOT NULL"
+        )
+
+    # historial por persona ya ordenado por fecha (get_visits)
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS ix_visits_person_when_epoch "
+        "ON visits(person_id, when_epoch DESC)"
+    )
+    cur.execute(
+        "CREATE INDEX IF NOT EXISTS ix_persons_updated_epoch "
+        "ON persons(updated_at_epoch)"
+    )
     con.commit()
-    con.close()
 
 
 def upsert_person(p):
@@ -126,62 +315,55 @@ def upsert_person(p):
       "critical_flags": ...,
       "notes": ...
     }
+    Regresa el registro tal como quedo escrito (mismas llaves que
+    get_person), para no releerlo de la DB.
     """
-    con = sqlite3.connect(DB_PATH)
+    con = get_conn()
     cur = con.cursor()
-    cur.execute("SELECT id FROM persons WHERE id=?", (p["id"],))
-    exists = cur.fetchone() is not None
-    now = datetime.utcnow().isoformat()
-
-    if exists:
-        cur.execute(
-            """
-            UPDATE persons
-            SET alias=?, birth_year=?, conditions=?, meds=?, allergies=?,
-                critical_flags=?, notes=?, updated_at=?
-            WHERE id=?
-            """,
-            (
-                p["alias"],
-                p["birth_year"],
-                p["conditions"],
-                p["meds"],
-                p["allergies"],
-                p["critical_flags"],
-                p["notes"],
-                now,
-                p["id"],
-            ),
-        )
-    else:
-        cur.execute(
-            """
-            INSERT INTO persons(id, alias, birth_year, conditions, meds,
-                                allergies, critical_flags, notes, updated_at)
-            VALUES (?,?,?,?,?,?,?,?,?)
-            """,
-            (
-                p["id"],
-                p["alias"],
-                p["birth_year"],
-                p["conditions"],
-                p["meds"],
-                p["allergies"],
-                p["critical_flags"],
-                p["notes"],
-                now,
-            ),
-        )
+    # una sola lectura del reloj para el texto ISO y el epoch
+    now_dt = datetime.now(timezone.utc)
+    now = now_dt.replace(tzinfo=None).isoformat()
+    now_epoch = int(now_dt.timestamp())
 
+    cur.execute(
+        """
+        INSERT INTO persons(id, alias, birth_year, conditions, meds,
+                            allergies, critical_flags, notes, updated_at,
+                            updated_at_epoch)
+        VALUES (?,?,?,?,?,?,?,?,?,?)
+        ON CONFLICT(id) DO UPDATE SET
+            alias=excluded.alias,
+            birth_year=excluded.birth_year,
+            conditions=excluded.conditions,
+            meds=excluded.meds,
+            allergies=excluded.allergies,
+            critical_flags=excluded.critical_flags,
+            notes=excluded.notes,
+            updated_at=excluded.updated_at,
+            updated_at_epoch=excluded.updated_at_epoch
+        """,
+        (
+            p["id"],
+            p["alias"],
+            p["birth_year"],
+            p["conditions"],
+            p["meds"],
+            p["allergies"],
+            p["critical_flags"],
+            p["notes"],
+            now,
+            now_epoch,
+        ),
+    )
     con.commit()
-    con.close()
+    return {**p, "updated_at": now}
 
 
 def get_person(person_id):
     """
     Devuelve un dict con los datos de la persona, o None si no existe.
     """
-    con = sqlite3.connect(DB_PATH)
+    con = get_conn()
     cur = con.cursor()
     cur.execute(
         """
@@ -193,74 +375,94 @@ def get_person(person_id):
         (person_id,),
     )
     row = cur.fetchone()
-    con.close()
 
     if not row:
         return None
 
-    keys = [
-        "id",
-        "alias",
-        "birth_year",
-        "conditions",
-        "meds",
-        "allergies",
-        "critical_flags",
-        "notes",
-        "updated_at",
-    ]
-    return dict(zip(keys, row))
+    return dict(row)
+
+
+def iso_to_epoch(when_):
+    """
+    Segundos epoch (int) de una fecha ISO; sin zona horaria se toma como UTC.
+    Si el texto no es una fecha valida regresa None, igual que el
+    strftime('%s', ...) de la migracion (esas visitas quedan al final).
+    """
+    try:
+        dt = datetime.fromisoformat(str(when_).strip())
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return int(dt.timestamp())
 
 
 def add_visit(person_id, when_, provider, summary):
     """
     Agrega visita clinica al historial.
     """
-    con = sqlite3.connect(DB_PATH)
-    cur = con.cursor()
-    cur.execute(
-        "INSERT INTO visits(person_id, when_, provider, summary) VALUES(?,?,?,?)",
-        (person_id, when_, provider, summary),
-    )
-    con.commit()
-    con.close()
+    add_visits(person_id, [(when_, provider, summary)])
+
+
+def add_visits(person_id, rows):
+    """
+    Agrega varias visitas [(when_, provider, summary), ...] con un solo
+    executemany dentro de una sola transaccion (un commit para todo el
+    lote, util para importar historial en bloque).
+    """
+    con = get_conn()
+    with con:
+        con.executemany(
+            "INSERT INTO visits(person_id, when_, provider, summary, when_epoch) "
+            "VALUES(?,?,?,?,?)",
+            [(person_id, w, p, s, iso_to_epoch(w)) for (w, p, s) in rows],
+        )
 
 
 def get_visits(person_id):
     """
     Devuelve lista de visitas [{when, provider, summary}, ...]
     """
-    con = sqlite3.connect(DB_PATH)
+    con = get_conn()
     cur = con.cursor()
     cur.execute(
         """
-        SELECT when_, provider, summary
+        SELECT when_ AS "when", provider, summary
         FROM visits
         WHERE person_id=?
-        ORDER BY when_ DESC
+        ORDER BY when_epoch DESC
         """,
         (person_id,),
     )
-    rows = cur.fetchall()
-    con.close()
-    return [{"when": r[0], "provider": r[1], "summary": r[2]} for r in rows]
+    return [dict(r) for r in cur.fetchall()]
 
 
 # -------------------------------------------------
 # QR + PDF
 # -------------------------------------------------
+@st.cache_data(show_spinner=False, max_entries=256)
 def make_qr_png(data_str):
     """
-    Genera un PNG en memoria con el QR que contiene data_str.
+    Genera un PNG (bytes) con el QR que contiene data_str. Cacheado: el mismo
+    data_str siempre produce el mismo PNG.
+    version=None + fit deja que qrcode elija la version segun el largo del
+    texto. El PNG se guarda en 1 bit (blanco/negro) sin convertir a RGB.
     """
-    qr = qrcode.QRCode(version=2, box_size=6, border=2)
+    import qrcode
+    import qrcode.image.pil
+
+    qr = qrcode.QRCode(
+        version=None,
+        box_size=6,
+        border=2,
+        image_factory=qrcode.image.pil.PilImage,
+    )
     qr.add_data(data_str)
     qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
+    img = qr.make_image(fill_color="black", back_color="white")
     buf = BytesIO()
-    img.save(buf, format="PNG")
-    buf.seek(0)
-    return buf
+    img.save(buf, format="PNG", optimize=False)
+    return buf.getvalue()
 
 
 def pdf_from_person(person, visits):
@@ -268,14 +470,16 @@ def pdf_from_person(person, visits):
     Genera un PDF (BytesIO) con la info medica + historial + QR que apunta
     a BASE_URL?id=<person_id>.
     """
+    from fpdf import FPDF, XPos, YPos
+
     pdf = FPDF()
     pdf.set_auto_page_break(auto=True, margin=12)
     pdf.add_page()
 
-    pdf.set_font("Arial", "B", 16)
-    pdf.cell(0, 10, "OpenHealth SD - Expediente", ln=True)
+    pdf.set_font("Helvetica", "B", 16)
+    pdf.cell(0, 10, "OpenHealth SD - Expediente", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
 
-    pdf.set_font("Arial", "", 11)
+    pdf.set_font("Helvetica", "", 11)
 
     def safe_txt(x):
         if x is None:
@@ -302,9 +506,9 @@ def pdf_from_person(person, visits):
     write_block("Notas", person.get("notes"))
 
     pdf.ln(2)
-    pdf.set_font("Arial", "B", 12)
-    pdf.cell(0, 8, "Historial de visitas", ln=True)
-    pdf.set_font("Arial", "", 11)
+    pdf.set_font("Helvetica", "B", 12)
+    pdf.cell(0, 8, "Historial de visitas", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
+    pdf.set_font("Helvetica", "", 11)
 
     if not visits:
         pdf.multi_cell(0, 7, "Sin visitas registradas")
@@ -317,23 +521,13 @@ def pdf_from_person(person, visits):
 
     # QR en el PDF
     pdf.ln(4)
-    pdf.set_font("Arial", "I", 10)
+    pdf.set_font("Helvetica", "I", 10)
     pdf.set_text_color(0, 0, 0)
-    pdf.cell(0, 8, "QR acceso rapido", ln=True)
+    pdf.cell(0, 8, "QR acceso rapido", new_x=XPos.LMARGIN, new_y=YPos.NEXT)
 
     qr_data = f"{BASE_URL}?id={person['id']}"
-    qr_buf = make_qr_png(qr_data)
-    tmp = BytesIO(qr_buf.read())
-    tmp.seek(0)
-    qr_img = Image.open(tmp)
-
-    img_path = f"qr_{person['id']}.png"
-    qr_img.save(img_path)
-    pdf.image(img_path, x=10, y=pdf.get_y(), w=30)
-    try:
-        os.remove(img_path)
-    except:
-        pass
+    # fpdf2 lee el PNG directo de memoria, sin archivo temporal en disco
+    pdf.image(BytesIO(make_qr_png(qr_data)), x=10, y=pdf.get_y(), w=30)
 
     output = BytesIO()
     pdf.output(output)
@@ -344,7 +538,16 @@ def pdf_from_person(person, visits):
 # -------------------------------------------------
 # INICIALIZAR DB
 # -------------------------------------------------
-init_db()
+@st.cache_resource(show_spinner=False)
+def init_db_once():
+    """
+    Corre init_db una sola vez por proceso (no en cada rerun).
+    """
+    init_db()
+    return True
+
+
+init_db_once()
 
 # leer query param ?id=xxxx del URL (para QR scan / deep link)
 qp = st.query_params  # Streamlit moderno
@@ -363,32 +566,102 @@ tabs = st.tabs(["Mapa", "Salud QR", "Recursos", "News & Clima"])
 # -------------------------------------------------
 # TAB 1: Mapa
 # -------------------------------------------------
-with tabs[0]:
-    st.subheader("Mapa de recursos")
+@st.cache_resource(show_spinner=False, max_entries=32)
+def build_deck(
+    data_version, sel_tipos, search_txt, max_km, user_lat, user_lon, _layer_df
+):
+    """
+    Arma el Deck de pydeck del mapa. _layer_df (no se hashea) queda
+    determinado por la version del CSV + los filtros, que son la llave de
+    cache: un rerun con los mismos filtros reusa el mismo Deck sin
+    reconstruir layer/view.
+    """
+    import pydeck as pdk
 
-    df_map = load_resources()
+    tooltip = {
+        "html": "<b>{name}</b><br/>{type}<br/>{address}<br/>Tel: {phone}<br/>Horario: {hours}<br/>{notes}",
+        "style": {"backgroundColor": "white", "color": "black"},
+    }
 
-    if df_map.empty:
-        st.warning("No hay datos en data/resources_sample.csv todavia. Se mostrara demo.")
-        # demo minimo para que no truene el mapa
-        demo_lat, demo_lon = DEFAULT_COORDS
-        df_map = pd.DataFrame(
-            [
-                {
-                    "name": "Demo Shelter",
-                    "type": "Shelter",
-                    "address": "123 Demo St",
-                    "lat": demo_lat,
-                    "lon": demo_lon,
-                    "hours": "24 horas",
-                    "phone": "619-000-0000",
-                    "notes": "Ejemplo demo",
-                }
-            ]
-        )
+    view_state = pdk.ViewState(
+        latitude=user_lat,
+        longitude=user_lon,
+        zoom=12,
+        pitch=0,
+    )
+
+    # records de tipos nativos de Python (una vez por llave de cache); lat/lon
+    # a 6 decimales (~0.1 m) para que el JSON al navegador sea mas corto
+    records = _layer_df.round({"lat": 6, "lon": 6}).to_dict(orient="records")
+
+    layer = pdk.Layer(
+        "ScatterplotLayer",
+        data=records,
+        get_position="[lon, lat]",
+        get_radius=80,
+        get_fill_color="[r, g, b]",
+        pickable=True,
+    )
+
+    return pdk.Deck(
+        layers=[layer],
+        initial_view_state=view_state,
+        tooltip=tooltip,
+        map_style="mapbox://styles/mapbox/dark-v10",
+    )
+
+
+@st.cache_resource(show_spinner=False, max_entries=4)
+def resource_arrays(data_version, _df_map):
+    """
+    Columnas que usa el filtro del Mapa como arrays numpy contiguos (uno por
+    columna), armados una vez por version del CSV. Los filtros trabajan
+    sobre estos arrays y el DataFrame solo se toca al final para las filas
+    que se muestran. Son de solo lectura: se comparten entre reruns.
+    """
+    coords = ("lat", "lon", "lat_rad", "lon_rad", "cos_lat")
+    type_cat = _df_map["type"].astype("category")
+    arrays = SimpleNamespace(
+        **{
+            c: np.ascontiguousarray(_df_map[c].to_numpy(dtype=np.float64))
+            for c in coords
+        },
+        type_code=type_cat.cat.codes.to_numpy(),
+        type_categories=type_cat.cat.categories,
+    )
+    for c in coords + ("type_code",):
+        getattr(arrays, c).flags.writeable = False
+    return arrays
+
+
+@st.cache_data(show_spinner=False)
+def default_order(data_version, _df_map):
+    """
+    Posiciones de las filas de _df_map (con tipo) ordenadas por distancia a
+    DEFAULT_COORDS, y esas distancias ya ordenadas. Es el estado inicial del
+    Mapa; se calcula una vez por version del CSV.
+    """
+    arrays = resource_arrays(data_version, _df_map)
+    idx = np.flatnonzero(arrays.type_code >= 0)
+    dist = haversine_km_vec(
+        DEFAULT_COORDS[0],
+        DEFAULT_COORDS[1],
+        arrays.lat_rad[idx],
+        arrays.lon_rad[idx],
+        arrays.cos_lat[idx],
+    )
+    order = np.argsort(dist, kind="stable")
+    return idx[order], dist[order]
 
+
+@st.fragment
+def render_mapa(df_map, tipos, data_version):
+    """
+    Filtros + mapa + tabla del tab Mapa. Como fragment, mover un filtro
+    solo vuelve a correr esta funcion y no todo el script.
+    data_version (mtime del CSV) identifica df_map para cachear el mapa.
+    """
     # --- filtros básicos ---
-    tipos = sorted(df_map["type"].dropna().unique().tolist())
     sel_tipos = st.multiselect(
         "Filtrar por tipo",
         options=tipos,
@@ -421,65 +694,66 @@ with tabs[0]:
         )
 
     # --- aplicar filtros ---
-    work_df = df_map.copy()
-
-    # por tipo
-    if sel_tipos:
-        work_df = work_df[work_df["type"].isin(sel_tipos)]
-
-    # texto
-    if search_txt.strip():
-        low = search_txt.strip().lower()
-        work_df = work_df[
-            work_df["name"].str.lower().str.contains(low)
-            | work_df["address"].str.lower().str.contains(low)
-        ]
-
-    # distancia
-    work_df["dist_km"] = work_df.apply(
-        lambda r: haversine_km(user_lat, user_lon, r["lat"], r["lon"]), axis=1
+    default_view = (
+        not search_txt.strip()
+        and bool(tipos)
+        and set(sel_tipos) == set(tipos)
+        and (user_lat, user_lon) == DEFAULT_COORDS
     )
-    work_df = work_df.sort_values("dist_km")
-    work_df = work_df[work_df["dist_km"] <= max_km]
-
-    # mapa pydeck
-    color_map = {
-        "Shelter": [0, 92, 230],
-        "Food": [0, 160, 60],
-        "Medical": [200, 0, 0],
-        "Hygiene": [200, 160, 0],
-        "Community": [120, 0, 120],
-    }
-    work_df["color"] = work_df["type"].apply(
-        lambda t: color_map.get(str(t), [200, 0, 200])
-    )
-
-    tooltip = {
-        "html": "<b>{name}</b><br/>{type}<br/>{address}<br/>Tel: {phone}<br/>Horario: {hours}<br/>{notes}",
-        "style": {"backgroundColor": "white", "color": "black"},
-    }
-
-    view_state = pdk.ViewState(
-        latitude=user_lat,
-        longitude=user_lon,
-        zoom=12,
-        pitch=0,
-    )
-
-    layer = pdk.Layer(
-        "ScatterplotLayer",
-        data=work_df,
-        get_position="[lon, lat]",
-        get_radius=80,
-        get_fill_color="color",
-        pickable=True,
-    )
-
-    deck_obj = pdk.Deck(
-        layers=[layer],
-        initial_view_state=view_state,
-        tooltip=tooltip,
-        map_style="mapbox://styles/mapbox/dark-v10",
+    if default_view:
+        # estado inicial: reusar el orden precalculado desde DEFAULT_COORDS y
+        # cortar al radio con busqueda binaria sobre las distancias ordenadas
+        idx, dist = default_order(data_version, df_map)
+        n = np.searchsorted(dist, max_km, side="right")
+        idx, dist = idx[:n], dist[:n]
+    else:
+        # se combinan en una sola mascara sobre los arrays y se materializa
+        # el DataFrame una vez
+        arrays = resource_arrays(data_version, df_map)
+        mask = np.ones(len(df_map), dtype=bool)
+
+        # por tipo (codigos de la categoria; -1 = sin tipo nunca coincide)
+        if sel_tipos:
+            wanted = np.flatnonzero(arrays.type_categories.isin(sel_tipos))
+            mask &= np.isin(arrays.type_code, wanted)
+
+        # texto
+        if search_txt.strip():
+            mask &= text_mask(df_map, search_txt)
+
+        # distancia: prefiltro por cuadro lat/lon, haversine solo en los que quedan
+        mask &= bbox_mask(arrays.lat, arrays.lon, user_lat, user_lon, max_km)
+        idx = np.flatnonzero(mask)
+        dist = haversine_km_vec(
+            user_lat,
+            user_lon,
+            arrays.lat_rad[idx],
+            arrays.lon_rad[idx],
+            arrays.cos_lat[idx],
+        )
+        # recortar al radio y ordenar por distancia sobre los arrays; el
+        # DataFrame solo se arma con las filas que se muestran
+        keep = dist <= max_km
+        idx, dist = idx[keep], dist[keep]
+        order = np.argsort(dist, kind="stable")
+        idx, dist = idx[order], dist[order]
+
+    work_df = df_map.iloc[idx].copy()
+    work_df["dist_km"] = dist
+
+    # mapa pydeck (solo las columnas que usa el layer: posicion, color y tooltip)
+    layer_df = work_df[
+        ["lon", "lat", "r", "g", "b", "name", "type", "address", "phone", "hours",
+         "notes"]
+    ]
+    deck_obj = build_deck(
+        data_version,
+        sel_tipos,
+        search_txt.strip().lower(),
+        max_km,
+        user_lat,
+        user_lon,
+        layer_df,
     )
 
     st.pydeck_chart(deck_obj, use_container_width=True, height=400)
@@ -496,6 +770,37 @@ with tabs[0]:
     )
 
 
+with tabs[0]:
+    st.subheader("Mapa de recursos")
+
+    res_mtime = resources_mtime()
+    df_map = load_resources(res_mtime)
+    tipos = resource_types(res_mtime)
+
+    if df_map.empty:
+        st.warning("No hay datos en data/resources_sample.csv todavia. Se mostrara demo.")
+        # demo minimo para que no truene el mapa
+        demo_lat, demo_lon = DEFAULT_COORDS
+        demo_df = pd.DataFrame(
+            [
+                {
+                    "name": "Demo Shelter",
+                    "type": "Shelter",
+                    "address": "123 Demo St",
+                    "lat": demo_lat,
+                    "lon": demo_lon,
+                    "hours": "24 horas",
+                    "phone": "619-000-0000",
+                    "notes": "Ejemplo demo",
+                }
+            ]
+        )
+        df_map = prepare_resources(demo_df)
+        tipos = sorted(df_map["type"].dropna().unique().tolist())
+
+    render_mapa(df_map, tipos, res_mtime)
+
+
 # -------------------------------------------------
 # TAB 2: Salud QR
 # -------------------------------------------------
@@ -537,7 +842,7 @@ with tabs[1]:
             submit_new = st.form_submit_button("Guardar y generar QR")
 
         if submit_new:
-            person_id = str(uuid.uuid4())[:8]  # ID corto tipo ab12cd34
+            person_id = secrets.token_hex(4)  # ID corto tipo ab12cd34
 
             p = {
                 "id": person_id,
@@ -549,17 +854,17 @@ with tabs[1]:
                 "critical_flags": critical_flags.strip(),
                 "notes": notes.strip(),
             }
-            upsert_person(p)
+            person_written = upsert_person(p)
 
             st.success(f"Guardado. ID asignado: {person_id}")
 
             # QR con link directo usando ?id=<ID>
             qr_url = f"{BASE_URL}?id={person_id}"
-            qr_png_buf = make_qr_png(qr_url)
+            qr_png = make_qr_png(qr_url)
 
             left, right = st.columns([1, 3])
             with left:
-                st.image(qr_png_buf, caption=f"QR ID {person_id}", width=160)
+                st.image(qr_png, caption=f"QR ID {person_id}", width=160)
             with right:
                 st.write(
                     "Escanear este QR abre OpenHealth con tu ID. "
@@ -570,17 +875,16 @@ with tabs[1]:
                     "Tambien puedes bajar tu hoja medica (PDF) e imprimirla."
                 )
 
-                visits_list = []
-                pdf_buf = pdf_from_person(get_person(person_id), visits_list)
+                # el PDF se genera solo cuando se da click en descargar
                 st.download_button(
                     "Descargar PDF medico",
-                    data=pdf_buf,
+                    data=lambda: pdf_from_person(person_written, []),
                     file_name=f"openhealth_{person_id}.pdf",
                     mime="application/pdf",
                 )
 
             st.write("Vista rapida de los datos guardados:")
-            st.json(get_person(person_id))
+            st.json(person_written)
 
     # ---------------------------
     # CONSULTAR POR ID
@@ -636,11 +940,10 @@ with tabs[1]:
 
                 # exportar PDF actualizado
                 st.subheader("Exportar PDF actualizado")
-                visits_now = get_visits(qid.strip())
-                pdf_buf = pdf_from_person(person, visits_now)
+                # el PDF se genera solo cuando se da click en descargar
                 st.download_button(
                     "Descargar PDF medico (actualizado)",
-                    data=pdf_buf,
+                    data=lambda: pdf_from_person(person, visits_now),
                     file_name=f"openhealth_{qid.strip()}.pdf",
                     mime="application/pdf",
                 )
@@ -652,7 +955,7 @@ with tabs[1]:
 with tabs[2]:
     st.subheader("Recursos comunitarios")
 
-    df_all = load_resources()
+    df_all = load_resources(resources_mtime())
     if df_all.empty:
         st.warning("No hay datos todavia en data/resources_sample.csv.")
     else: